@@ -3,6 +3,7 @@ import torch
 import torch.nn as nn 
 from transformers.models.gpt2.modeling_gpt2 import GPT2Attention, GPT2MLP
 from transformers.activations import ACT2FN
+from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
 from transformers.pytorch_utils import Conv1D
 
 from typing import Optional, Tuple, Union
@@ -11,9 +12,107 @@ from modular_transformers.models.loss_utils import l2_reg, l1_reg, l2_curvature,
 
 loss_functions = {"l2_reg": l2_reg, "l1_reg": l1_reg, "l2_curvature": l2_curvature, "l0_curvature": l0_curvature, "l1_curvature": l1_curvature, "curvature": curvature, "l0_curvature_max": l0_curvature_max, "sparsity": sparsity}
 
+#one causal mask per (size, device), shared by every attention layer, instead of each
+#layer registering its own (1, 1, block_size, block_size) buffer (4MB each at 1024)
+_causal_masks = {}
+
+def _get_causal_mask(size, device):
+    key = (size, str(device))
+    if key not in _causal_masks:
+        _causal_masks[key] = torch.tril(
+            torch.ones((size, size), dtype=torch.bool, device=device)
+        ).view(1, 1, size, size)
+    return _causal_masks[key]
+
+"""
+Same attention computation as the hugging face GPT2Attention but routed through the
+fused scaled_dot_product_attention kernel (FlashAttention / memory-efficient attention)
+so the (T, T) attention matrix is never materialized in HBM
+"""
+class SdpaAttention(GPT2Attention):
+    def __init__(self, config, is_cross_attention=False, layer_idx=None):
+        super().__init__(config, is_cross_attention=is_cross_attention, layer_idx=layer_idx)
+        #drop the per-layer mask buffers; self.bias is served from the shared cache
+        self._causal_mask_size = self._buffers["bias"].size(-1)
+        del self._buffers["bias"]
+        self._buffers.pop("masked_bias", None)
+
+    @property
+    def bias(self):
+        return _get_causal_mask(self._causal_mask_size, self.c_attn.weight.device)
+
+    def _attn(self, query, key, value, attention_mask=None, head_mask=None):
+        #the fused kernels can't express head masks or GPT2's optional alternative scalings,
+        #fall back to the eager path for those
+        if (
+            head_mask is not None
+            or not self.scale_attn_weights
+            or self.scale_attn_by_inverse_layer_idx
+        ):
+            return super()._attn(query, key, value, attention_mask, head_mask)
+
+        query_length, key_length = query.size(-2), key.size(-2)
+        attn_mask = None
+        is_causal = False
+        if self.is_cross_attention:
+            attn_mask = attention_mask
+        elif attention_mask is None:
+            #let the kernel generate the causal mask itself, no HBM reads at all
+            is_causal = query_length > 1
+        else:
+            #combine the causal mask with the additive padding mask built by GPT2Model
+            causal_mask = self.bias[:, :, key_length - query_length : key_length, :key_length]
+            mask_value = torch.finfo(query.dtype).min
+            attn_mask = torch.where(
+                causal_mask,
+                attention_mask.to(query.dtype),
+                torch.full((), mask_value, dtype=query.dtype, device=query.device),
+            )
+
+        attn_output = nn.functional.scaled_dot_product_attention(
+            query,
+            key,
+            value,
+            attn_mask=attn_mask,
+            dropout_p=self.attn_dropout.p if self.training else 0.0,
+            is_causal=is_causal,
+        )
+        #attention weights are never formed, so there is nothing to return for them
+        return attn_output, None
+
+"""
+Same computation as the hugging face GPT2MLP but with the GELU+dropout chain expressed
+as functional ops, so TorchInductor can fuse the pointwise work (bias add, activation,
+dropout) into one kernel under torch.compile instead of one HBM round trip per op
+"""
+class FusedMLP(GPT2MLP):
+    def __init__(self, intermediate_size, config):
+        super().__init__(intermediate_size, config)
+        #"gelu_new"/"gelu_pytorch_tanh" are the tanh approximation; plain "gelu" is the
+        #exact erf form and has to stay exact, Inductor fuses either one
+        if config.activation_function in ("gelu_new", "gelu_pytorch_tanh"):
+            self.approximate = "tanh"
+        else:
+            self.approximate = "none"
+
+    def forward(self, hidden_states):
+        hidden_states = self.c_fc(hidden_states)
+        hidden_states = nn.functional.gelu(hidden_states, approximate=self.approximate)
+        hidden_states = self.c_proj(hidden_states)
+        hidden_states = nn.functional.dropout(
+            hidden_states, p=self.dropout.p, training=self.training
+        )
+        return hidden_states
+
 class Transformer(transformers.GPT2Model):
     def __init__(self, config=None):
+        #the inherited constructor would build a full stack of stock GPT2Blocks that get
+        #replaced right below, materializing every block's parameters twice; hide the
+        #layers from it so only our own blocks are ever allocated
+        n_layer = config.n_layer
+        config.n_layer = 0
         super().__init__(config)
+        config.n_layer = n_layer
         self.h = nn.ModuleList()
         self.hook_functions = {}
         self.hook_losses = {}
@@ -111,14 +210,18 @@ class TransformerBlock(nn.Module):
         inner_dim = config.n_inner if config.n_inner is not None else 4 * hidden_size
 
         self.ln_1 = nn.LayerNorm(hidden_size, eps=config.layer_norm_epsilon)
-        self.attn = GPT2Attention(config, layer_idx=layer_idx)
+        self.attn = SdpaAttention(config, layer_idx=layer_idx)
         self.ln_2 = nn.LayerNorm(hidden_size, eps=config.layer_norm_epsilon)
 
         if config.add_cross_attention:
-            self.crossattention = GPT2Attention(config, is_cross_attention=True, layer_idx=layer_idx)
+            self.crossattention = SdpaAttention(config, is_cross_attention=True, layer_idx=layer_idx)
             self.ln_cross_attn = nn.LayerNorm(hidden_size, eps=config.layer_norm_epsilon)
 
-        self.mlp = GPT2MLP(inner_dim, config)
+        #the fused forward hardcodes the GELU chain, keep the stock MLP for anything else
+        if config.activation_function in ("gelu", "gelu_new", "gelu_pytorch_tanh"):
+            self.mlp = FusedMLP(inner_dim, config)
+        else:
+            self.mlp = GPT2MLP(inner_dim, config)
         
         #MY ADDITION, NEED TO CHANGE THE EMBEDDING SIZE
         if config.output_dim != hidden_size:
@@ -194,12 +297,64 @@ class TransformerBlock(nn.Module):
     
 
 
+#compute the LM loss without materializing the full (B*T, vocab) logits tensor, which
+#at batch 32 x context 1024 x vocab 50257 is ~3GB in bf16; logits are formed for one
+#chunk of the sequence at a time and reduced into the loss immediately
+def _chunked_lm_loss(lm_head, hidden_states, labels, chunk_size=256):
+    #shift so tokens < n predict n
+    hidden_states = hidden_states[:, :-1]
+    targets = labels[:, 1:]
+    total_loss = hidden_states.new_zeros((), dtype=torch.float32)
+    total_count = hidden_states.new_zeros((), dtype=torch.float32)
+    for start in range(0, hidden_states.size(1), chunk_size):
+        logits = lm_head(hidden_states[:, start : start + chunk_size])
+        chunk_targets = targets[:, start : start + chunk_size]
+        total_loss = total_loss + nn.functional.cross_entropy(
+            logits.reshape(-1, logits.size(-1)).float(),
+            chunk_targets.reshape(-1),
+            ignore_index=-100,
+            reduction="sum",
+        )
+        total_count = total_count + (chunk_targets != -100).sum()
+    return total_loss / total_count
+
 class LM(transformers.GPT2LMHeadModel):
     def __init__(self, config=None):
+        #same trick as Transformer: keep the inherited constructor from building a stock
+        #block stack that is thrown away when self.transformer is replaced
+        n_layer = config.n_layer
+        config.n_layer = 0
         super().__init__(config)
+        config.n_layer = n_layer
         self.transformer = Transformer(config)
         self.post_init()
-    
+
+    def forward(self, input_ids=None, labels=None, **kwargs):
+        #loss-only calls (the training/eval loops) take the chunked path; anything that
+        #needs logits, caches or intermediate outputs defers to the stock forward
+        if (
+            labels is None
+            or kwargs.get("use_cache")
+            or kwargs.get("output_attentions")
+            or kwargs.get("output_hidden_states")
+            or kwargs.get("return_dict") is False
+        ):
+            return super().forward(input_ids=input_ids, labels=labels, **kwargs)
+        kwargs.pop("return_dict", None)
+        transformer_outputs = self.transformer(input_ids, return_dict=True, **kwargs)
+        loss = _chunked_lm_loss(
+            self.lm_head, transformer_outputs.last_hidden_state, labels
+        )
+        #logits are never formed in full on this path
+        return CausalLMOutputWithCrossAttentions(
+            loss=loss,
+            logits=None,
+            past_key_values=transformer_outputs.past_key_values,
+            hidden_states=transformer_outputs.hidden_states,
+            attentions=transformer_outputs.attentions,
+            cross_attentions=transformer_outputs.cross_attentions,
+        )
+
     def forward_with_extra_loss(self, input, labels=None, attention_mask=None, attn_indices=None):
         self.transformer.attn_mask = attn_indices
         response = super().forward(input, labels=labels, attention_mask=attention_mask)
@@ -207,16 +362,19 @@ class LM(transformers.GPT2LMHeadModel):
 
     def remove_hooks(self):
         self.transformer.remove_hooks()
-    
+
     def set_hooks(self):
         self.transformer.set_hooks()
 
     def output_extra_losses(self):
         return self.transformer.output_extra_losses()
-    
+
 class ClassificationLM(transformers.GPT2ForSequenceClassification):
     def __init__(self, config=None):
+        n_layer = config.n_layer
+        config.n_layer = 0
         super().__init__(config)
+        config.n_layer = n_layer
         self.transformer = Transformer(config)
         self.pad_token_id = config.pad_token_id
         self.post_init()
@@ -2,10 +2,54 @@ import logging
 import sys
 from collections import OrderedDict
 import torch
+import torch.nn as nn
 import copy
 from tqdm import tqdm
 import numpy as np
 from numpy.random.mtrand import RandomState
+from transformers.pytorch_utils import Conv1D
+
+# Conv1D computes x @ W + b with the weight stored transposed relative to nn.Linear;
+# quantize_dynamic only recognizes nn.Linear, so swap the projections in place first
+def _conv1d_to_linear(module):
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            in_features, out_features = child.weight.shape
+            linear = nn.Linear(in_features, out_features)
+            linear.weight = nn.Parameter(child.weight.t().contiguous())
+            linear.bias = nn.Parameter(child.bias.clone())
+            setattr(module, name, linear)
+        else:
+            _conv1d_to_linear(child)
+
+# returns a CPU copy of the model with every linear projection (Q/K/V/O and the MLP,
+# after Conv1D -> Linear conversion) dynamically quantized to int8 for no_grad
+# evaluation; the original model and its gradients are untouched
+def quantize_for_inference(model, dtype=torch.qint8):
+    model_int8 = copy.deepcopy(model).cpu().eval()
+    _conv1d_to_linear(model_int8)
+    return torch.ao.quantization.quantize_dynamic(model_int8, {nn.Linear}, dtype=dtype)
+
+# fold a LayerNorm's elementwise affine into the Conv1D that consumes its output:
+# (g * xhat + b) @ W + c == xhat @ (g[:, None] * W) + (b @ W + c). The normalization
+# itself still has to run, but it does so with identity scale/shift
+def _fold_ln_into_conv1d(ln, conv):
+    with torch.no_grad():
+        conv.bias.copy_(conv.bias + ln.bias @ conv.weight)
+        conv.weight.mul_(ln.weight.unsqueeze(1))
+        ln.weight.fill_(1.0)
+        ln.bias.zero_()
+
+# returns an eval copy of the model with every block's ln_1/ln_2 affine folded into
+# attn.c_attn / mlp.c_fc; numerically identical to the original in fp32. ln_f is left
+# alone because lm_head has no bias to absorb its shift into
+def fold_layernorms_for_inference(model):
+    assert not model.training
+    model_folded = copy.deepcopy(model).eval()
+    for block in model_folded.transformer.h:
+        _fold_ln_into_conv1d(block.ln_1, block.attn.c_attn)
+        _fold_ln_into_conv1d(block.ln_2, block.mlp.c_fc)
+    return model_folded
 
 def permute_mat(mat):
     mat_flat = mat.flatten()
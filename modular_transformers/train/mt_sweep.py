@@ -1,11 +1,20 @@
 import os
 
+# expandable segments avoid the allocator fragmentation that the per-epoch
+# empty_cache() calls used to paper over; must be set before torch touches CUDA
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
 import torch
 from torch.utils.data import DataLoader
 from datasets import load_dataset, load_from_disk
 import accelerate
 from accelerate import Accelerator, DeepSpeedPlugin
-from accelerate.utils import LoggerType, DummyOptim, DummyScheduler
+from accelerate.utils import (
+    LoggerType,
+    DummyOptim,
+    DummyScheduler,
+    DistributedDataParallelKwargs,
+)
 from transformers import (
     AdamW,
     AutoTokenizer,
@@ -17,7 +26,13 @@ from transformers import (
 )
 from tqdm.auto import tqdm
 import math
-from modular_transformers.train.utils import Group_Texts
+import threading
+from modular_transformers.train.utils import (
+    Group_Texts,
+    MemmapDataset,
+    CUDAPrefetcher,
+    cache_grouped_dataset,
+)
 from pathlib import Path
 import sys
 
@@ -41,24 +56,119 @@ Set config to use DeepSpeed
 MAX_GPU_BATCH_SIZE = 32
 EVAL_BATCH_SIZE = 32
 CONTEXT_LENGTH = 1024
+LOG_INTERVAL = 10
 
 
 # obviously hardcoding gradient accumulation steps is not ideal, but it's the only way to get the code to run
+# DeepSpeed stays opt-in (ACCELERATE_USE_DEEPSPEED=true, as set by 'accelerate config')
+# so single-GPU debug runs don't need it installed and the plain optimizer path below
+# stays reachable
+if os.environ.get("ACCELERATE_USE_DEEPSPEED", "false") == "true":
+    deepspeed_plugin = DeepSpeedPlugin(
+        zero_stage=2,
+        gradient_accumulation_steps=64 // MAX_GPU_BATCH_SIZE,
+        offload_optimizer_device="none",
+    )
+    # partition optimizer state + gradients across ranks and overlap the gradient
+    # reduce-scatter with backward compute
+    deepspeed_plugin.deepspeed_config["zero_optimization"].update(
+        {"contiguous_gradients": True, "overlap_comm": True}
+    )
+else:
+    deepspeed_plugin = None
 accelerator = Accelerator(
-    log_with="wandb", gradient_accumulation_steps=64 // MAX_GPU_BATCH_SIZE
+    log_with="wandb",
+    gradient_accumulation_steps=64 // MAX_GPU_BATCH_SIZE,
+    mixed_precision="bf16",
+    deepspeed_plugin=deepspeed_plugin,
+    # on the plain DDP path, make grads views into the bucket buffers instead of a
+    # second full copy of the parameters; ignored under DeepSpeed
+    kwargs_handlers=[DistributedDataParallelKwargs(gradient_as_bucket_view=True)],
 )
 
 
+# Stacks examples into batch tensors inside the DataLoader workers, so the per-step
+# stack runs ahead of time instead of on the main process in the training loop
+def collate(examples):
+    # fill preallocated batch tensors in place: copy_ widens the memmap cache's
+    # int32/uint8 rows straight into long storage (ids double as cross entropy
+    # labels), skipping the intermediate stacked batch plus the cast copy. The
+    # buffers can't be reused across calls because batches stay in flight while the
+    # loader prefetches, so each batch is one allocation with no extra copies; the
+    # DataLoader's pin_memory thread then pins it for the non-blocking H2D copy
+    seq_len = len(examples[0]["input_ids"])
+    input_ids = torch.empty((len(examples), seq_len), dtype=torch.long)
+    attention_mask = torch.empty((len(examples), seq_len), dtype=torch.long)
+    for i, example in enumerate(examples):
+        input_ids[i].copy_(torch.as_tensor(example["input_ids"]))
+        attention_mask[i].copy_(torch.as_tensor(example["attention_mask"]))
+    return input_ids, attention_mask
+
+
+# handle to the in-flight background checkpoint write, if any
+_checkpoint_thread = None
+
+
+def _state_to_cpu(obj):
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: _state_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_state_to_cpu(value) for value in obj]
+    return obj
+
+
+# Snapshot state to CPU, then hand the slow serialization to a background thread so the
+# ranks only stall for the CPU-side copy, not for the disk write
+def save_checkpoint(accelerator, model, optimizer, lr_scheduler, epoch, step, save_dir):
+    global _checkpoint_thread
+    save_dir.mkdir(parents=True, exist_ok=True)
+    accelerator.wait_for_everyone()
+    # all ranks participate here (ZeRO needs to gather the partitions)
+    state_dict = accelerator.get_state_dict(model)
+    if not accelerator.is_main_process:
+        return
+    # don't let two writes race if checkpoints come faster than the disk keeps up
+    if _checkpoint_thread is not None:
+        _checkpoint_thread.join()
+    state_dict = _state_to_cpu(state_dict)
+    accelerator_states = _state_to_cpu(
+        {
+            "epoch": epoch,
+            "steps": step,
+            "optimizer": optimizer.state_dict(),
+            "scheduler": lr_scheduler.state_dict(),
+        }
+    )
+    unwrapped_model = accelerator.unwrap_model(model)
+
+    def _write():
+        # safetensors serialization skips python pickling for the weights
+        unwrapped_model.save_pretrained(
+            save_dir, state_dict=state_dict, safe_serialization=True
+        )
+        torch.save(accelerator_states, os.path.join(save_dir, "accelerator_states"))
+
+    _checkpoint_thread = threading.Thread(target=_write, daemon=True)
+    _checkpoint_thread.start()
+
+
 # Evaluate function
 def evaluate(model, eval_dataloader, accelerator):
     model.eval()
-    losses = []
+    # accumulate into one device scalar instead of growing a python list of gathered
+    # losses, which synced every step and needed an O(n_steps) stack at the end
+    total_loss = torch.zeros((), device=accelerator.device)
+    count = 0
     for step, batch in tqdm(enumerate(eval_dataloader), total=len(eval_dataloader)):
         with torch.no_grad():
-            batch = torch.stack(batch["input_ids"]).transpose(1, 0)
-            outputs = model(batch, labels=batch)
-        losses.append(accelerator.gather(outputs.loss))
-    loss = torch.mean(torch.stack(losses))
+            input_ids, attention_mask = batch
+            outputs = model(input_ids, labels=input_ids)
+        gathered = accelerator.gather(outputs.loss)
+        total_loss += gathered.sum()
+        count += gathered.numel()
+    loss = total_loss / count
     try:
         perplexity = torch.exp(loss)
     except OverflowError:
@@ -86,26 +196,64 @@ def main():
     tokenizer.pad_token = tokenizer.eos_token
 
     path = "/om/weka/evlab/ehoseini/MyData/miniBERTa_v2/"
-    grouped_pad_train = load_from_disk(
-        os.path.join(
-            path, f"miniBERTa-{data}-crunched", f"train_context_len_{CONTEXT_LENGTH}"
-        )
+    # read from the contiguous memmap cache instead of the Arrow datasets; the cache
+    # is written once by the main process on the first run
+    train_cache = os.path.join(
+        path, f"miniBERTa-{data}-crunched", f"train_memmap_context_len_{CONTEXT_LENGTH}"
     )
-    grouped_pad_valid = load_from_disk(
-        os.path.join(
-            path, f"miniBERTa-{data}-crunched", f"valid_context_len_{CONTEXT_LENGTH}"
-        )
+    valid_cache = os.path.join(
+        path, f"miniBERTa-{data}-crunched", f"valid_memmap_context_len_{CONTEXT_LENGTH}"
     )
+    if accelerator.is_main_process:
+        if not MemmapDataset.exists(train_cache):
+            cache_grouped_dataset(
+                load_from_disk(
+                    os.path.join(
+                        path,
+                        f"miniBERTa-{data}-crunched",
+                        f"train_context_len_{CONTEXT_LENGTH}",
+                    )
+                ),
+                train_cache,
+                CONTEXT_LENGTH,
+            )
+        if not MemmapDataset.exists(valid_cache):
+            cache_grouped_dataset(
+                load_from_disk(
+                    os.path.join(
+                        path,
+                        f"miniBERTa-{data}-crunched",
+                        f"valid_context_len_{CONTEXT_LENGTH}",
+                    )
+                ),
+                valid_cache,
+                CONTEXT_LENGTH,
+            )
+    accelerator.wait_for_everyone()
+    grouped_pad_train = MemmapDataset(train_cache)
+    grouped_pad_valid = MemmapDataset(valid_cache)
 
     if train_config["batch_size"] > MAX_GPU_BATCH_SIZE:
         gradient_accumulation_steps = train_config["batch_size"] // MAX_GPU_BATCH_SIZE
         batch_size = MAX_GPU_BATCH_SIZE
 
     eval_dataloader = DataLoader(
-        grouped_pad_valid, shuffle=False, batch_size=EVAL_BATCH_SIZE
+        grouped_pad_valid,
+        shuffle=False,
+        batch_size=EVAL_BATCH_SIZE,
+        collate_fn=collate,
+        num_workers=4,
+        pin_memory=True,
+        persistent_workers=True,
     )
     train_dataloader = DataLoader(
-        grouped_pad_train, shuffle=True, batch_size=batch_size
+        grouped_pad_train,
+        shuffle=True,
+        batch_size=batch_size,
+        collate_fn=collate,
+        num_workers=4,
+        pin_memory=True,
+        persistent_workers=True,
     )
     del grouped_pad_train, grouped_pad_valid
 
@@ -143,22 +291,65 @@ def main():
 
     tracker.config.update(train_config)
 
-    torch.cuda.empty_cache()
+    # the attention modules call scaled_dot_product_attention; keep the unfused math
+    # fallback disabled so the flash / memory-efficient kernels are always selected
+    if torch.cuda.is_available():
+        torch.backends.cuda.enable_flash_sdp(True)
+        torch.backends.cuda.enable_mem_efficient_sdp(True)
+        torch.backends.cuda.enable_math_sdp(False)
+
     model.output_loss = True
+
+    # recompute block activations during backward instead of holding all of them;
+    # ~30% extra compute for roughly n_layer-fold less activation memory at this
+    # context length, which is what lets MAX_GPU_BATCH_SIZE stay at 32
+    model.gradient_checkpointing_enable()
+    model.config.use_cache = False
+
     model_size = sum(t.numel() for t in model.parameters())
     print(f"{model_name} size: {model_size / 1000 ** 2:.1f}M parameters")
     print(model)
     model = model.to(accelerator.device)
 
+    # fuse the pointwise ops (LayerNorm, GELU, residual adds, dropout) and strip eager
+    # dispatch overhead; fullgraph=False because the loss-hook branches can graph-break
+    model = torch.compile(
+        model, mode="reduce-overhead", fullgraph=False, backend="inductor"
+    )
+
     # Define optimizer
-    # Creates Dummy Optimizer if `optimizer` was specified in the config file else creates AdamW Optimizer
-    optimizer_cls = (
-        torch.optim.AdamW
-        if accelerator.state.deepspeed_plugin is None
-        or "optimizer" not in accelerator.state.deepspeed_plugin.deepspeed_config
-        else DummyOptim
+    # Creates Dummy Optimizer if `optimizer` was specified in the config file,
+    # DeepSpeed's fused Adam when running under a DeepSpeed plugin, else AdamW
+    optimizer_kwargs = {}
+    if (
+        accelerator.state.deepspeed_plugin is not None
+        and "optimizer" in accelerator.state.deepspeed_plugin.deepspeed_config
+    ):
+        optimizer_cls = DummyOptim
+    elif accelerator.state.deepspeed_plugin is not None:
+        from deepspeed.ops.adam import FusedAdam
+
+        optimizer_cls = FusedAdam
+    else:
+        optimizer_cls = None
+        if torch.cuda.is_available():
+            try:
+                # quantize the Adam m/v state to 8 bit, ~1GB -> ~250MB for this
+                # model size; DeepSpeed runs keep their own partitioned FusedAdam
+                from bitsandbytes.optim import AdamW8bit
+
+                optimizer_cls = AdamW8bit
+            except ImportError:
+                pass
+        if optimizer_cls is None:
+            optimizer_cls = torch.optim.AdamW
+            # one fused kernel over every parameter update instead of separate m/v/p
+            # launches per tensor per step
+            if torch.cuda.is_available():
+                optimizer_kwargs["fused"] = True
+    optimizer = optimizer_cls(
+        params=model.parameters(), lr=train_config["lr"], **optimizer_kwargs
     )
-    optimizer = optimizer_cls(params=model.parameters(), lr=train_config["lr"])
     if (
         accelerator.state.deepspeed_plugin is None
         or "scheduler" not in accelerator.state.deepspeed_plugin.deepspeed_config
@@ -180,46 +371,58 @@ def main():
         )
     )
 
+    # overlap the next batch's H2D copy with the current step's compute
+    train_dataloader = CUDAPrefetcher(train_dataloader, accelerator.device)
+    eval_dataloader = CUDAPrefetcher(eval_dataloader, accelerator.device)
+
     # Logging variables
     n_steps_per_epoch = math.ceil(len(train_dataloader.dataset) / batch_size)
     data_count = 0
     absolute_step = 0
+    running_loss = 0.0
+    running_loss_steps = 0
     # Begin training for number of epochs
 
     for epoch in tqdm(range(train_config["num_epochs"])):
         model.train()
-        torch.cuda.empty_cache()
         for step, batch in tqdm(
             enumerate(train_dataloader), total=len(train_dataloader)
         ):
-            batch = [
-                torch.stack(batch[x]).transpose(1, 0)
-                for x in ["input_ids", "attention_mask"]
-            ]
+            input_ids, attention_mask = batch
 
             with accelerator.accumulate(model):
-                outputs = model(batch[0], labels=batch[0], attention_mask=batch[1])
+                outputs = model(
+                    input_ids, labels=input_ids, attention_mask=attention_mask
+                )
                 loss = outputs.loss
 
                 accelerator.backward(loss)
                 lr_scheduler.step()
                 optimizer.step()
-                optimizer.zero_grad()
+                # free the gradient tensors instead of memset-ing ~500MB of zeros
+                optimizer.zero_grad(set_to_none=True)
 
-            data_count += batch[0].shape[0]
+            data_count += input_ids.shape[0]
 
             absolute_step += 1
 
-            accelerator.log({"train/train_loss": loss}, step=absolute_step)
-            accelerator.log(
-                {"train/epoch": (absolute_step + 1) / n_steps_per_epoch},
-                step=absolute_step,
-            )
-            accelerator.log({"train/data_count": data_count}, step=absolute_step)
-            accelerator.log(
-                {"train/learning_rate": lr_scheduler.get_last_lr()[0]},
-                step=absolute_step,
-            )
+            # detach so the logged loss doesn't keep the autograd graph alive
+            running_loss += loss.detach().float()
+            running_loss_steps += 1
+
+            # one batched log call every LOG_INTERVAL steps instead of four per step
+            if absolute_step % LOG_INTERVAL == 0:
+                accelerator.log(
+                    {
+                        "train/train_loss": (running_loss / running_loss_steps).item(),
+                        "train/epoch": (absolute_step + 1) / n_steps_per_epoch,
+                        "train/data_count": data_count,
+                        "train/learning_rate": lr_scheduler.get_last_lr()[0],
+                    },
+                    step=absolute_step,
+                )
+                running_loss = 0.0
+                running_loss_steps = 0
 
             if absolute_step % 200 == 0:
                 model.eval()
@@ -234,56 +437,27 @@ def main():
                     {"validation/valid_accuracy": valid_accuracy}, step=absolute_step
                 )
                 model.train()
-                torch.cuda.empty_cache()
 
             if absolute_step % 20000 == 0:
                 save_dir = Path(
                     f"/om2/user/jackking/MyData/mt/miniberta_{data}/{model_name}/{run_name}/checkpoint_{absolute_step}"
                 )
-                save_dir.mkdir(parents=True, exist_ok=True)
-                accelerator.wait_for_everyone()
-                unwrapped_model = accelerator.unwrap_model(model)
-                unwrapped_model.save_pretrained(
-                    save_dir,
-                    is_main_process=accelerator.is_main_process,
-                    save_function=accelerator.save,
-                    state_dict=accelerator.get_state_dict(model),
-                )
-                accelerator.save(
-                    {
-                        "epoch": epoch,
-                        "steps": step,
-                        "optimizer": optimizer.state_dict(),
-                        "scheduler": lr_scheduler.state_dict(),
-                    },
-                    os.path.join(save_dir, "accelerator_states"),
+                save_checkpoint(
+                    accelerator, model, optimizer, lr_scheduler, epoch, step, save_dir
                 )
 
     # Save final model
     save_dir = Path(
         f"/om2/user/jackking/MyData/mt/miniberta_{data}/{model_name}/{run_name}/checkpoint_{absolute_step}"
     )
-    save_dir.mkdir(parents=True, exist_ok=True)
-    accelerator.wait_for_everyone()
-    unwrapped_model = accelerator.unwrap_model(model)
-    unwrapped_model.save_pretrained(
-        save_dir,
-        is_main_process=accelerator.is_main_process,
-        save_function=accelerator.save,
-        state_dict=accelerator.get_state_dict(model),
-    )
-    accelerator.save(
-        {
-            "epoch": epoch,
-            "steps": step,
-            "optimizer": optimizer.state_dict(),
-            "scheduler": lr_scheduler.state_dict(),
-        },
-        os.path.join(save_dir, "accelerator_states"),
+    save_checkpoint(
+        accelerator, model, optimizer, lr_scheduler, epoch, step, save_dir
     )
+    # make sure the last background write reached disk before tearing down
+    if _checkpoint_thread is not None:
+        _checkpoint_thread.join()
 
     accelerator.end_training()
-    torch.cuda.empty_cache()
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import os
+import shutil
 import torch
 import tiktoken
 import numpy as np
@@ -39,6 +40,164 @@ specifically the group_texts function.
 """
 
 
+"""
+Contiguous on-disk cache for a grouped dataset.
+
+Arrow datasets store the token columns as lists, which forces per-example Python
+list -> tensor conversion on every epoch. Writing the grouped dataset once into
+memmapped (N, seq_len) arrays turns every batch fetch into a single contiguous read.
+
+To use:
+    Call cache_grouped_dataset(...) once to write the cache (input_ids as int32,
+    attention_mask as uint8), then construct MemmapDataset over the cache directory
+    and hand it to a DataLoader in place of the Arrow dataset.
+"""
+
+
+class MemmapDataset(torch.utils.data.Dataset):
+    def __init__(self, cache_dir):
+        self.input_ids = np.load(
+            os.path.join(cache_dir, "input_ids.npy"), mmap_mode="r"
+        )
+        self.attention_mask = np.load(
+            os.path.join(cache_dir, "attention_mask.npy"), mmap_mode="r"
+        )
+
+    @staticmethod
+    def exists(cache_dir):
+        return os.path.exists(os.path.join(cache_dir, "input_ids.npy")) and os.path.exists(
+            os.path.join(cache_dir, "attention_mask.npy")
+        )
+
+    def __len__(self):
+        return self.input_ids.shape[0]
+
+    def __getitem__(self, idx):
+        # np.array copies the row out of the page cache so the tensors are writable;
+        # at seq_len 1024 that is a 4KB copy, negligible next to the Arrow decode it replaces
+        return {
+            "input_ids": np.array(self.input_ids[idx]),
+            "attention_mask": np.array(self.attention_mask[idx]),
+        }
+
+
+"""
+Double-buffered iterator over a DataLoader: the next batch's host-to-device copy is
+issued on a side CUDA stream while the current step computes, hiding the transfer
+behind the GPU work. Needs pinned host memory for the copies to actually run
+asynchronously. Falls back to plain iteration when CUDA is unavailable.
+"""
+
+
+class CUDAPrefetcher:
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if torch.cuda.is_available() else None
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, iterator):
+        # pull the batch inside the stream context: accelerate's prepared loaders do
+        # their own device placement within next(), so both that copy and the fallback
+        # .to below are issued on the side stream instead of the compute stream
+        with torch.cuda.stream(self.stream):
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return None
+            return tuple(
+                t.to(self.device, non_blocking=True) if torch.is_tensor(t) else t
+                for t in batch
+            )
+
+    def _consume_end_signal(self):
+        # accelerate's DataLoaderShard raises its end_of_dataloader flag the moment
+        # the final batch is *fetched*, which with the one-batch look-ahead is while
+        # the consumer is still on the batch before it - GradientState would then
+        # force a gradient sync one micro-batch early. Hide the flag here and
+        # remember it so it can be restored when the final batch is actually yielded
+        is_last = getattr(self.loader, "end_of_dataloader", False)
+        if is_last:
+            self.loader.end_of_dataloader = False
+        return is_last
+
+    def __iter__(self):
+        if self.stream is None:
+            yield from self.loader
+            return
+        iterator = iter(self.loader)
+        next_batch = self._preload(iterator)
+        next_is_last = self._consume_end_signal()
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            batch = next_batch
+            for t in batch:
+                if torch.is_tensor(t):
+                    # keep the allocation alive on the side stream until this
+                    # stream is done with it
+                    t.record_stream(torch.cuda.current_stream())
+            if next_is_last:
+                # restore the end-of-dataloader signal for the batch it belongs to,
+                # and only let the wrapped iterator finish (deregistering itself
+                # from GradientState) once the consumer has processed that batch
+                self.loader.end_of_dataloader = True
+                yield batch
+                try:
+                    next(iterator)
+                except StopIteration:
+                    pass
+                break
+            # kick off the next copy before handing the current batch to the caller
+            next_batch = self._preload(iterator)
+            next_is_last = self._consume_end_signal()
+            yield batch
+
+
+def cache_grouped_dataset(grouped_dataset, cache_dir, seq_len, batch_size=1000):
+    # Streams the grouped dataset into memmapped arrays in a scratch directory, then
+    # renames it into place. open_memmap preallocates the full-size files up front, so
+    # a writer killed mid-stream must never leave anything where MemmapDataset.exists
+    # looks: the partially written (zero-filled) cache would be silently trained on.
+    # The rename is atomic, which also resolves independent jobs racing on the same
+    # shared-filesystem path; callers should check MemmapDataset.exists first to skip
+    # the rewrite
+    scratch_dir = f"{cache_dir}.tmp-{os.getpid()}"
+    os.makedirs(scratch_dir, exist_ok=True)
+    n_examples = len(grouped_dataset)
+    input_ids = np.lib.format.open_memmap(
+        os.path.join(scratch_dir, "input_ids.npy"),
+        mode="w+",
+        dtype=np.int32,
+        shape=(n_examples, seq_len),
+    )
+    attention_mask = np.lib.format.open_memmap(
+        os.path.join(scratch_dir, "attention_mask.npy"),
+        mode="w+",
+        dtype=np.uint8,
+        shape=(n_examples, seq_len),
+    )
+    grouped_dataset = grouped_dataset.with_format("numpy")
+    for start in range(0, n_examples, batch_size):
+        batch = grouped_dataset[start : start + batch_size]
+        input_ids[start : start + batch_size] = batch["input_ids"]
+        attention_mask[start : start + batch_size] = batch["attention_mask"]
+    input_ids.flush()
+    attention_mask.flush()
+    del input_ids, attention_mask
+    try:
+        os.rename(scratch_dir, cache_dir)
+    except OSError:
+        # another writer finished first; trust its cache and drop ours
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    return MemmapDataset(cache_dir)
+
+
 class Group_Texts:
     def __init__(
         self,
@@ -8,7 +8,8 @@ with open("README.md") as readme_file:
 
 requirements = [
     "accelerate",
-    "torch==1.13.1",
+    "torch>=2.1",
+    "safetensors",
     "numpy==1.23.5",
     "pytest==7.2.2",
     "black==23.1.0",